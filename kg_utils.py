@@ -0,0 +1,40 @@
+# Shared helpers for the graph-building and visualization scripts.
+import hashlib
+import pickle
+
+# Rust-backed Oxigraph store when oxrdflib is installed, rdflib's default otherwise
+try:
+    import oxrdflib  # noqa: F401
+    GRAPH_STORE = "Oxigraph"
+except ImportError:
+    GRAPH_STORE = "default"
+
+# --- Graph layout: Graphviz sfdp if available, cached on disk across runs ---
+def graph_digest(G):
+    # Identifies the graph's structure: same nodes *and* same edges
+    nodes = sorted(str(n) for n in G.nodes())
+    edges = sorted((str(u), str(v)) for u, v in G.edges())
+    return hashlib.sha256(repr((nodes, edges)).encode("utf-8")).hexdigest()
+
+def cached_layout(G, cache_file, **fallback_kwargs):
+    # Imported here so the pipeline scripts that only need GRAPH_STORE don't pull in networkx
+    import networkx as nx
+
+    # Reuse the stored positions only when they were computed for the same graph
+    digest = graph_digest(G)
+    try:
+        with open(cache_file, "rb") as f:
+            cached = pickle.load(f)
+        if cached["graph"] == digest:
+            return cached["pos"]
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError, KeyError, TypeError):
+        pass
+
+    try:
+        pos = nx.nx_agraph.graphviz_layout(G, prog="sfdp")
+    except ImportError:  # pygraphviz not installed
+        pos = nx.spring_layout(G, **fallback_kwargs)
+
+    with open(cache_file, "wb") as f:
+        pickle.dump({"graph": digest, "pos": pos}, f)
+    return pos
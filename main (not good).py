@@ -1,17 +1,31 @@
 # --- Imports ---
+import os
 from rdflib import Graph, Namespace, URIRef, Literal
 from rdflib.namespace import RDF, OWL, XSD
-from SPARQLWrapper import SPARQLWrapper, JSON
+from requests import RequestException
+from kg_utils import GRAPH_STORE
+from sparql_client import (
+    DBPEDIA_SPARQL, WIKIDATA_SPARQL, WIKIDATA_CITIES_Q, open_cache, sparql, values_block,
+)
 
-# --- SPARQL Endpoints ---
-DBPEDIA_SPARQL = "https://dbpedia.org/sparql"
-WIKIDATA_SPARQL = "https://query.wikidata.org/sparql"
+# --- SPARQL result cache (one file per script) ---
+open_cache("main_sparql_cache")
 
-db_sparql = SPARQLWrapper(DBPEDIA_SPARQL)
-db_sparql.setReturnFormat(JSON)
+# The federated query is opt-in (KG_FEDERATED_QUERY=1) until it has been
+# verified against the live endpoints; by default the two-step path is used
+USE_FEDERATED_QUERY = os.environ.get("KG_FEDERATED_QUERY") == "1"
 
-wd_sparql = SPARQLWrapper(WIKIDATA_SPARQL)
-wd_sparql.setReturnFormat(JSON)
+# --- Namespaces ---
+WIKIDATA_ENTITY_PREFIX = "http://www.wikidata.org/entity/"
+GEONAMES_PREFIX = "http://sws.geonames.org/"
+
+EX = Namespace("http://example.org/ontology/")
+
+EX_CITY = EX.City
+EX_LOCATED_IN = EX.locatedIn
+EX_TYPE_STRING = EX.typeString
+EX_LOCATION_STRING = EX.locationString
+EX_IS_VERIFIED_CITY = EX.isVerifiedCity
 
 # =====================================================
 # STEP 1: Build DBpedia URI
@@ -21,138 +35,176 @@ def to_dbpedia_uri(location_string):
     return f"http://dbpedia.org/resource/{clean}"
 
 # =====================================================
-# STEP 2: Resolve Redirects
+# STEP 2: Resolve redirects, owl:sameAs links and the
+#         Wikidata city check in one federated query (opt-in)
 # =====================================================
-def resolve_redirect(uri):
-    query = f"""
+# Sent to Wikidata: the DBpedia SERVICE block carries the location URIs
+# explicitly, and the city check runs locally through EXISTS on each
+# returned ?same, so no part of the query is evaluated unbound.
+LOCATION_LINKS_Q = """
     PREFIX dbo: <http://dbpedia.org/ontology/>
-    SELECT ?target WHERE {{
-      <{uri}> dbo:wikiPageRedirects ?target .
-    }}
+    PREFIX owl: <http://www.w3.org/2002/07/owl#>
+    PREFIX wdt: <http://www.wikidata.org/prop/direct/>
+    PREFIX wd: <http://www.wikidata.org/entity/>
+    SELECT DISTINCT ?s ?resolved ?same ?isCity WHERE {
+      SERVICE <https://dbpedia.org/sparql> {
+        VALUES ?s { %s }
+        OPTIONAL { ?s dbo:wikiPageRedirects ?target . }
+        BIND(COALESCE(?target, ?s) AS ?resolved)
+        OPTIONAL { ?resolved owl:sameAs ?same . }
+      }
+      BIND(BOUND(?same) && EXISTS { ?same (wdt:P31/wdt:P279*) wd:Q515 . } AS ?isCity)
+    }
     """
-    db_sparql.setQuery(query)
-    results = db_sparql.query().convert()
-    bindings = results["results"]["bindings"]
-    return bindings[0]["target"]["value"] if bindings else uri
+
+def get_location_links(uris):
+    if not USE_FEDERATED_QUERY:
+        return get_location_links_two_step(uris)
+
+    query = LOCATION_LINKS_Q % values_block(uris)
+    try:
+        results = sparql(WIKIDATA_SPARQL, query)
+    except RequestException:
+        # Endpoint refused, failed or timed out on the federated query
+        return get_location_links_two_step(uris)
+    resolved = {uri: uri for uri in uris}
+    links = {uri: [] for uri in uris}
+    cities = set()
+    for b in results["results"]["bindings"]:
+        uri = b["s"]["value"]
+        resolved[uri] = b["resolved"]["value"]
+        if "same" in b:
+            links[uri].append(b["same"]["value"])
+            if b.get("isCity", {}).get("value") == "true":
+                cities.add(b["same"]["value"])
+    return resolved, links, cities
 
 # =====================================================
-# STEP 3: Get owl:sameAs links
+# STEP 2b: Default path without federation, two round-trips:
+#          one DBpedia query (redirects + owl:sameAs links)
+#          and one Wikidata query (city check)
 # =====================================================
-def get_sameas_links(dbpedia_uri):
-    query = f"""
+SAMEAS_Q = """
+    PREFIX dbo: <http://dbpedia.org/ontology/>
     PREFIX owl: <http://www.w3.org/2002/07/owl#>
-    SELECT DISTINCT ?same WHERE {{
-      <{dbpedia_uri}> owl:sameAs ?same .
-    }}
+    SELECT DISTINCT ?s ?resolved ?same WHERE {
+      VALUES ?s { %s }
+      OPTIONAL { ?s dbo:wikiPageRedirects ?target . }
+      BIND(COALESCE(?target, ?s) AS ?resolved)
+      OPTIONAL { ?resolved owl:sameAs ?same . }
+    }
     """
-    db_sparql.setQuery(query)
-    results = db_sparql.query().convert()
-    return [b["same"]["value"] for b in results["results"]["bindings"]]
-
 
+def get_sameas_bulk(uris):
+    query = SAMEAS_Q % values_block(uris)
+    results = sparql(DBPEDIA_SPARQL, query)
+    resolved = {uri: uri for uri in uris}
+    links = {uri: [] for uri in uris}
+    for b in results["results"]["bindings"]:
+        uri = b["s"]["value"]
+        resolved[uri] = b["resolved"]["value"]
+        if "same" in b:
+            links[uri].append(b["same"]["value"])
+    return resolved, links
+
+def get_wikidata_cities_bulk(wd_uris):
+    if not wd_uris:
+        return set()
+    query = WIKIDATA_CITIES_Q % values_block(wd_uris)
+    results = sparql(WIKIDATA_SPARQL, query)
+    return {b["wd"]["value"] for b in results["results"]["bindings"]}
+
+def get_location_links_two_step(uris):
+    resolved, links = get_sameas_bulk(uris)
+    wd_candidates = {l for same in links.values() for l in same if l.startswith(WIKIDATA_ENTITY_PREFIX)}
+    cities = get_wikidata_cities_bulk(sorted(wd_candidates))
+    return resolved, links, cities
 
 # =====================================================
-# STEP 4: Check if Wikidata entity is a city
+# STEP 3: Combine steps for all locations
 # =====================================================
-def is_city_wikidata(wd_uri):
-    query = f"""
-    PREFIX wdt: <http://www.wikidata.org/prop/direct/>
-    PREFIX wd: <http://www.wikidata.org/entity/>
-    ASK {{
-      <{wd_uri}> (wdt:P31/wdt:P279*) wd:Q515 .
-    }}
-    """
-    wd_sparql.setQuery(query)
-    return wd_sparql.query().convert()["boolean"]
+def link_poi_to_city(location_strings):
+    db_uris = {loc: to_dbpedia_uri(loc) for loc in location_strings}
+    resolved, sameas, cities = get_location_links(list(set(db_uris.values())))
+
+    infos = {}
+    for loc, db_uri in db_uris.items():
+        resolved_uri = resolved[db_uri]
+        links = sameas[db_uri]
+
+        # Partition the links in a single pass
+        wd_links, geo_links = [], []
+        for l in links:
+            if l.startswith(WIKIDATA_ENTITY_PREFIX):
+                wd_links.append(l)
+            elif l.startswith(GEONAMES_PREFIX):
+                geo_links.append(l)
+        # print(wd_links)
+        # print(geo_links)
+
+        # Take the first wd_links entry that is a verified Wikidata city
+        verified_wd_uri = next((wd_uri for wd_uri in wd_links if wd_uri in cities), None)
+        is_city = verified_wd_uri is not None
+
+        verified_geo_uri = None
+        if geo_links:
+            # Choose the GeoNames URI that is not equal to verified_wd_uri
+            for geo_uri in geo_links:
+                if geo_uri != verified_wd_uri:
+                    verified_geo_uri = geo_uri
+                    break
+
+        infos[loc] = {
+            "location_string": loc,
+            "dbpedia_uri": resolved_uri,
+            "wikidata_uri": verified_wd_uri,
+            "geonames_uri": verified_geo_uri,
+            "is_city": is_city
+        }
+
+    return infos
 
 # =====================================================
-# STEP 5: Combine steps for one location
+# STEP 4: Create RDF triples
 # =====================================================
-def link_poi_to_city(location_string):
-    db_uri = to_dbpedia_uri(location_string)
-    resolved = resolve_redirect(db_uri)
-    links = get_sameas_links(resolved)
-
-    wd_links = [l for l in links if "wikidata.org/entity" in l]
-    # print(wd_links)
-    geo_links = [l for l in links if "geonames.org" in l]
-    # print(geo_links)
-
-    is_city = False
-    verified_wd_uri = None
-
-    # Go through every wd_links entry until a Wikidata city is found
-    for wd_uri in wd_links:
-        if is_city_wikidata(wd_uri):
-            is_city = True
-            verified_wd_uri = wd_uri
-            break  # stop at the first verified city
-
-    # If no city found, is_city remains False and we continue
-
-    verified_geo_uri = None
-    if geo_links:
-        # Choose the GeoNames URI that is not equal to verified_wd_uri
-        for geo_uri in geo_links:
-            if geo_uri != verified_wd_uri:
-                verified_geo_uri = geo_uri
-                break
-
-
-
-    return {
-        "location_string": location_string,
-        "dbpedia_uri": resolved,
-        "wikidata_uri": verified_wd_uri,
-        "geonames_uri": verified_geo_uri,
-        "is_city": is_city
-    }
+def create_poi_city_triples(poi_uri, type_string, location_info, g=None):
+    # Add to the given graph, or to a new one if none is passed
+    if g is None:
+        g = Graph(store=GRAPH_STORE)
 
-# =====================================================
-# STEP 6: Create RDF triples
-# =====================================================
-def create_poi_city_triples(poi_uri, type_string, location_info):
-    g = Graph()
-
-    EX = Namespace("http://example.org/ontology/")
-    DBR = Namespace("http://dbpedia.org/resource/")
-    WD = Namespace("http://www.wikidata.org/entity/")
-    GEO = Namespace("http://sws.geonames.org/")
-    
     poi = URIRef(poi_uri)
     city = URIRef(location_info["dbpedia_uri"])
 
-    # POI triples
-    g.add((poi, RDF.type, EX[type_string]))
-    g.add((poi, EX.locatedIn, city))
-    g.add((poi, EX.typeString, Literal(type_string)))
-    g.add((poi, EX.locationString, Literal(location_info["location_string"])))
-
-    # City triples
-    g.add((city, RDF.type, EX.City))
+    quads = [
+        # POI triples
+        (poi, RDF.type, EX[type_string], g),
+        (poi, EX_LOCATED_IN, city, g),
+        (poi, EX_TYPE_STRING, Literal(type_string), g),
+        (poi, EX_LOCATION_STRING, Literal(location_info["location_string"]), g),
+
+        # City triples
+        (city, RDF.type, EX_CITY, g),
+        (city, EX_IS_VERIFIED_CITY, Literal(location_info["is_city"], datatype=XSD.boolean), g),
+    ]
     if location_info.get("wikidata_uri"):
-        g.add((city, OWL.sameAs, URIRef(location_info["wikidata_uri"])))
+        quads.append((city, OWL.sameAs, URIRef(location_info["wikidata_uri"]), g))
     if location_info.get("geonames_uri"):
-        g.add((city, OWL.sameAs, URIRef(location_info["geonames_uri"])))
-    g.add((city, EX.isVerifiedCity, Literal(location_info["is_city"], datatype=XSD.boolean)))
+        quads.append((city, OWL.sameAs, URIRef(location_info["geonames_uri"]), g))
+    g.addN(quads)
 
     return g
 
 # =====================================================
-# STEP 7: Run for 3 example locations
+# STEP 5: Run for 3 example locations
 # =====================================================
 locations = ["Barcelona", "Madrid", "Valencia"]
 
-graphs = []
-for loc in locations:
-    info = link_poi_to_city(loc)
-    g = create_poi_city_triples(f"http://dbpedia.org/resource/POI_in_{loc}", "Attraction", info)
-    graphs.append(g)
+infos = link_poi_to_city(locations)
 
-# Merge and print
-final_graph = Graph()
-for g in graphs:
-    final_graph += g
+# Build all triples directly into one graph and print
+final_graph = Graph(store=GRAPH_STORE)
+for loc in locations:
+    create_poi_city_triples(f"http://dbpedia.org/resource/POI_in_{loc}", "Attraction", infos[loc], g=final_graph)
 
 print(final_graph.serialize(format="turtle"))
 
@@ -160,27 +212,21 @@ print(final_graph.serialize(format="turtle"))
 import networkx as nx
 import matplotlib.pyplot as plt
 from rdflib import URIRef
+from kg_utils import cached_layout
 
 def rdf_to_networkx(graph):
     G = nx.DiGraph()  # Directed graph
-    for s, p, o in graph:
-        # Only include URI nodes for clarity
-        if isinstance(s, URIRef) and isinstance(o, URIRef):
-            G.add_edge(s, o, label=p.split('#')[-1] if '#' in p else str(p).split('/')[-1])
+    # Only include URI nodes for clarity
+    G.add_edges_from(
+        (s, o, {"label": p.split('#')[-1] if '#' in p else str(p).split('/')[-1]})
+        for s, p, o in graph
+        if isinstance(s, URIRef) and isinstance(o, URIRef)
+    )
     return G
 
 # Example: convert your final_graph from previous steps
 G = rdf_to_networkx(final_graph)
 
-plt.figure(figsize=(12,8))
-pos = nx.spring_layout(G, k=0.5)  # Force-directed layout
-nx.draw(G, pos, with_labels=True, node_size=1500, node_color="lightblue", font_size=10, arrows=True)
-edge_labels = nx.get_edge_attributes(G, 'label')
-nx.draw_networkx_edge_labels(G, pos, edge_labels=edge_labels, font_color='red')
-plt.title("POI → City Knowledge Graph")
-plt.show()
-
-
 node_colors = []
 for node in G.nodes():
     if "POI_in" in str(node):
@@ -188,7 +234,13 @@ for node in G.nodes():
     else:
         node_colors.append("lightgreen")
 
-nx.draw(G, pos, with_labels=True, node_color=node_colors, node_size=1500, arrows=True)
+plt.figure(figsize=(12,8))
+pos = cached_layout(G, "poi_city_pos.pkl", k=0.5)  # Force-directed layout
+nx.draw(G, pos, with_labels=True, node_size=1500, node_color=node_colors, font_size=10, arrows=True)
+edge_labels = nx.get_edge_attributes(G, 'label')
+nx.draw_networkx_edge_labels(G, pos, edge_labels=edge_labels, font_color='red')
+plt.title("POI → City Knowledge Graph")
+plt.show()
 
 
 
@@ -0,0 +1,105 @@
+# Shared SPARQL client for the pipeline scripts:
+# one pooled HTTP session plus an in-memory and on-disk result cache.
+import atexit
+import hashlib
+import shelve
+import time
+from functools import lru_cache
+import ijson
+import requests
+from requests.adapters import HTTPAdapter
+
+# --- SPARQL Endpoints ---
+DBPEDIA_SPARQL = "https://dbpedia.org/sparql"
+WIKIDATA_SPARQL = "https://query.wikidata.org/sparql"
+
+# Wikimedia's User-Agent policy asks for a descriptive agent with contact info
+USER_AGENT = (
+    "Knowledge-Graph-team-project/0.1 "
+    "(https://github.com/limescha22/Knowledge-Graph-team-project)"
+)
+
+# Sent by both the requests session and the aiohttp requests
+SPARQL_HEADERS = {
+    "Accept": "application/sparql-results+json",
+    "Accept-Encoding": "gzip",
+    "User-Agent": USER_AGENT,
+}
+
+# (connect, read) timeouts in seconds, so a hanging endpoint raises instead of blocking
+SPARQL_TIMEOUT = (10, 70)
+
+# One pooled keep-alive session for the synchronous queries
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=16))
+SESSION.headers.update(SPARQL_HEADERS)
+
+# Results are cached in memory and on disk, keyed on a digest of (endpoint, query).
+# The query text embeds both the template and the URI, so keys never collide.
+SPARQL_CACHE_TTL = 24 * 60 * 60  # seconds
+
+# Plain dict until open_cache() is called, i.e. no persistence
+sparql_cache = {}
+
+def open_cache(filename):
+    # Each script passes its own file, so two scripts can run at the same time
+    global sparql_cache
+    sparql_cache = shelve.open(filename)
+    atexit.register(sparql_cache.close)
+
+def cache_key(endpoint, query):
+    # Fixed-size key: queries with large VALUES blocks are several KB long
+    return hashlib.sha256(f"{endpoint}\n{query}".encode("utf-8")).hexdigest()
+
+def cached_result(endpoint, query):
+    key = cache_key(endpoint, query)
+    entry = sparql_cache.get(key)
+    if entry is None:
+        return None
+    if time.time() - entry[0] >= SPARQL_CACHE_TTL:
+        del sparql_cache[key]  # expired, drop it so the file does not grow forever
+        return None
+    return entry[1]
+
+def store_result(endpoint, query, result):
+    sparql_cache[cache_key(endpoint, query)] = (time.time(), result)
+
+@lru_cache(maxsize=10000)
+def sparql(endpoint, query):
+    result = cached_result(endpoint, query)
+    if result is None:
+        resp = SESSION.post(endpoint, data={"query": query}, timeout=SPARQL_TIMEOUT)
+        resp.raise_for_status()
+        result = resp.json()
+        store_result(endpoint, query, result)
+    return result
+
+def sparql_stream(endpoint, query):
+    # Yield result bindings one by one while the response is still downloading.
+    # The bindings are collected on the way and cached once the stream is complete.
+    result = cached_result(endpoint, query)
+    if result is not None:
+        yield from result["results"]["bindings"]
+        return
+
+    bindings = []
+    with SESSION.post(endpoint, data={"query": query}, stream=True, timeout=SPARQL_TIMEOUT) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        for b in ijson.items(resp.raw, "results.bindings.item"):
+            bindings.append(b)
+            yield b
+    store_result(endpoint, query, {"results": {"bindings": bindings}})
+
+# Wikidata entities (from a VALUES block) that are instances of city (Q515)
+WIKIDATA_CITIES_Q = """
+    PREFIX wdt: <http://www.wikidata.org/prop/direct/>
+    PREFIX wd: <http://www.wikidata.org/entity/>
+    SELECT DISTINCT ?wd WHERE {
+      VALUES ?wd { %s }
+      ?wd (wdt:P31/wdt:P279*) wd:Q515 .
+    }
+    """
+
+def values_block(uris):
+    return " ".join(f"<{u}>" for u in uris)
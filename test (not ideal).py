@@ -1,19 +1,41 @@
-from SPARQLWrapper import SPARQLWrapper, JSON
-import re
+import asyncio
+import os
+import aiohttp
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import pandas as pd
 from tqdm import tqdm
+from tqdm.asyncio import tqdm_asyncio
 from rdflib import Graph, URIRef, Literal, Namespace, RDF, RDFS, OWL
+from kg_utils import GRAPH_STORE
+from sparql_client import (
+    DBPEDIA_SPARQL, WIKIDATA_SPARQL, WIKIDATA_CITIES_Q, SPARQL_HEADERS,
+    cached_result, open_cache, sparql, sparql_stream, store_result, values_block,
+)
 
 # -------------------------------
-# 1. Setup SPARQL endpoints
+# 1. SPARQL client setup
 # -------------------------------
-DBPEDIA_SPARQL = "https://dbpedia.org/sparql"
-sparql_db = SPARQLWrapper(DBPEDIA_SPARQL)
-sparql_db.setReturnFormat(JSON)
+open_cache("test_sparql_cache")
 
-WIKIDATA_SPARQL = "https://query.wikidata.org/sparql"
-sparql_wd = SPARQLWrapper(WIKIDATA_SPARQL)
-sparql_wd.setReturnFormat(JSON)
+# Max number of SPARQL queries in flight per endpoint
+# (WDQS answers more than 5 parallel queries per client with 429)
+MAX_CONCURRENT_QUERIES = {DBPEDIA_SPARQL: 8, WIKIDATA_SPARQL: 5}
+
+# Throttled / temporarily unavailable responses are retried, not fatal
+RETRY_STATUSES = {429, 502, 503, 504}
+MAX_RETRIES = 5
+
+# Max number of URIs inlined into one VALUES block
+VALUES_BATCH_SIZE = 200
+
+def batches(items, size=VALUES_BATCH_SIZE):
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+# The pretty-printed turtle dump is slow and only meant for humans,
+# so it is written only when KG_WRITE_TURTLE=1 is set
+WRITE_TURTLE = os.environ.get("KG_WRITE_TURTLE") == "1"
 
 # Namespaces
 DCT = Namespace("http://purl.org/dc/terms/")
@@ -21,170 +43,295 @@ SKOS = Namespace("http://www.w3.org/2004/02/skos/core#")
 EX = Namespace("http://example.org/kg/")
 DBR = Namespace("http://dbpedia.org/resource/")
 
+EX_POI = EX.POI
+EX_CITY = EX.City
+EX_LOCATED_IN = EX.locatedIn
+EX_TYPE_STRING = EX.typeString
+EX_HAS_TYPE = EX.hasType
+EX_ATTRACTION_TYPE = EX.AttractionType
+
 # -------------------------------
-# 2. Regex for category parsing
+# 2. Category parsing
 # -------------------------------
-CATEGORY_REGEX = re.compile(r"http://dbpedia\.org/resource/Category:(.+?)_(in|of)_(.+)")
+CATEGORY_PREFIX = "http://dbpedia.org/resource/Category:"
 
 def parse_category_uri(category_uri):
-    m = CATEGORY_REGEX.match(category_uri)
-    if m:
-        type_str = m.group(1).replace("_", " ")
-        location_str = m.group(3).replace("_", " ")
-        return type_str, location_str
+    # "<Type>_in_<Location>" / "<Type>_of_<Location>", split at the first separator
+    if category_uri.startswith(CATEGORY_PREFIX):
+        tail = category_uri[len(CATEGORY_PREFIX):]
+        cuts = [i for i in (tail.find("_in_", 1), tail.find("_of_", 1)) if i != -1]
+        if cuts:
+            cut = min(cuts)
+            type_part, location_part = tail[:cut], tail[cut + 4:]
+            if location_part:
+                return type_part.replace("_", " "), location_part.replace("_", " ")
     return None, None
 
 # -------------------------------
 # 3. Get visitor attraction categories
 # -------------------------------
-def get_visitor_attraction_categories(limit=50):
-    query = f"""
-    SELECT DISTINCT ?category WHERE {{
+CATEGORIES_Q = """
+    SELECT DISTINCT ?category WHERE {
       ?category a skos:Concept .
       FILTER regex(str(?category), "^http://dbpedia.org/resource/Category:Tourist_attractions_in_")
-    }} LIMIT {limit}
+    } LIMIT %d
     """
-    sparql_db.setQuery(query)
-    results = sparql_db.query().convert()
+
+def get_visitor_attraction_categories(limit=50):
+    query = CATEGORIES_Q % limit
+    results = sparql(DBPEDIA_SPARQL, query)
     return [r['category']['value'] for r in results['results']['bindings']]
 
 # -------------------------------
 # 4. Get POIs for a category
 # -------------------------------
-def get_pois_for_category(category_uri):
-    query = f"""
-    SELECT DISTINCT ?POI ?category WHERE {{
+POIS_Q = """
+    SELECT DISTINCT ?POI ?category WHERE {
       ?POI <http://purl.org/dc/terms/subject> ?category .
-      ?category <http://www.w3.org/2004/02/skos/core#broader> <{category_uri}> .
-    }}
+      ?category <http://www.w3.org/2004/02/skos/core#broader> <%s> .
+    }
     """
-    sparql_db.setQuery(query)
-    results = sparql_db.query().convert()
-    pois = []
-    for r in results['results']['bindings']:
-        poi = r['POI']['value']
-        cat = r['category']['value']
-        pois.append((poi, cat))
-    return pois
+
+def get_pois_for_category(category_uri):
+    query = POIS_Q % category_uri
+    for r in sparql_stream(DBPEDIA_SPARQL, query):
+        yield r['POI']['value'], r['category']['value']
 
 # -------------------------------
-# 5. Get Wikidata mapping for POI
+# 5. Async SPARQL request (JSON results)
 # -------------------------------
-def get_wikidata_mapping(poi_uri):
-    query = f"""
+pending_queries = {}
+endpoint_semaphores = {}
+
+def retry_delay(resp, attempt):
+    # Honour Retry-After (seconds or HTTP date), else back off exponentially
+    retry_after = resp.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            try:
+                when = parsedate_to_datetime(retry_after)
+                return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    return 2 ** attempt
+
+async def fetch_json(session, endpoint, query):
+    result = cached_result(endpoint, query)
+    if result is not None:
+        return result
+
+    if endpoint not in endpoint_semaphores:
+        endpoint_semaphores[endpoint] = asyncio.Semaphore(MAX_CONCURRENT_QUERIES[endpoint])
+    sem = endpoint_semaphores[endpoint]
+
+    for attempt in range(MAX_RETRIES + 1):
+        async with sem:
+            async with session.post(
+                endpoint,
+                data={"query": query},
+                headers=SPARQL_HEADERS,
+            ) as resp:
+                if resp.status in RETRY_STATUSES and attempt < MAX_RETRIES:
+                    delay = retry_delay(resp, attempt)
+                else:
+                    resp.raise_for_status()
+                    result = await resp.json(content_type=None)
+                    break
+        # Wait outside the semaphore so other queries can use the slot
+        await asyncio.sleep(delay)
+
+    store_result(endpoint, query, result)
+    return result
+
+async def sparql_json(session, endpoint, query):
+    # Identical queries share one request, even while it is still running
+    key = (endpoint, query)
+    if key not in pending_queries:
+        pending_queries[key] = asyncio.ensure_future(fetch_json(session, endpoint, query))
+    return await pending_queries[key]
+
+# -------------------------------
+# 6. Get Wikidata mappings for POIs (batched)
+# -------------------------------
+WIKIDATA_MAPPING_Q = """
     PREFIX owl: <http://www.w3.org/2002/07/owl#>
-    SELECT DISTINCT ?wikidata WHERE {{
-      <{poi_uri}> owl:sameAs ?wikidata .
+    SELECT DISTINCT ?poi ?wikidata WHERE {
+      VALUES ?poi { %s }
+      ?poi owl:sameAs ?wikidata .
       FILTER(STRSTARTS(STR(?wikidata), "http://www.wikidata.org/entity/"))
-    }}
+    }
     """
-    sparql_db.setQuery(query)
-    results = sparql_db.query().convert()
-    return [r["wikidata"]["value"] for r in results["results"]["bindings"]]
+
+async def get_wikidata_mappings(session, poi_uris):
+    query = WIKIDATA_MAPPING_Q % values_block(poi_uris)
+    results = await sparql_json(session, DBPEDIA_SPARQL, query)
+    mappings = {uri: [] for uri in poi_uris}
+    for r in results["results"]["bindings"]:
+        mappings[r["poi"]["value"]].append(r["wikidata"]["value"])
+    return mappings
 
 # -------------------------------
-# 6. Get Wikidata type hierarchy (P279 3-level)
+# 7. Get Wikidata type hierarchies (P279 3-level, batched)
 # -------------------------------
-def get_wikidata_type_hierarchy(wd_uri):
-    query = f"""
+TYPE_HIERARCHY_Q = """
     PREFIX wdt: <http://www.wikidata.org/prop/direct/>
-    PREFIX wikibase: <http://wikiba.se/ontology#>
-    PREFIX bd: <http://www.bigdata.com/rdf#>
 
-    SELECT DISTINCT ?super ?superLabel WHERE {{
-      <{wd_uri}> (wdt:P279 | wdt:P279/wdt:P279 | wdt:P279/wdt:P279/wdt:P279) ?super .
-      SERVICE wikibase:label {{ bd:serviceParam wikibase:language "en". }}
-    }}
+    SELECT DISTINCT ?wd ?s1 ?s2 ?s3 WHERE {
+      VALUES ?wd { %s }
+      ?wd wdt:P279 ?s1 .
+      OPTIONAL {
+        ?s1 wdt:P279 ?s2 .
+        OPTIONAL { ?s2 wdt:P279 ?s3 . }
+      }
+    }
     """
-    sparql_wd.setQuery(query)
-    results = sparql_wd.query().convert()
-    return [(r["super"]["value"], r["superLabel"]["value"]) for r in results["results"]["bindings"]]
-
-# =====================================================
-# STEP X: Check if Wikidata entity is a city
-# =====================================================
-def is_city_wikidata(wd_uri):
-    query = f"""
-    PREFIX wdt: <http://www.wikidata.org/prop/direct/>
-    PREFIX wd: <http://www.wikidata.org/entity/>
-    ASK {{
-      <{wd_uri}> (wdt:P31/wdt:P279*) wd:Q515 .
-    }}
-    """
-    sparql_wd.setQuery(query)
-    return sparql_wd.query().convert()["boolean"]
+
+async def get_wikidata_type_hierarchies(session, wd_uris):
+    # Returns {wd_uri: [[s1, s2, s3], ...]}, one superclass path per row,
+    # ordered by depth and cut at the first missing level
+    query = TYPE_HIERARCHY_Q % values_block(wd_uris)
+    results = await sparql_json(session, WIKIDATA_SPARQL, query)
+    hierarchies = {uri: [] for uri in wd_uris}
+    for r in results["results"]["bindings"]:
+        path = []
+        for var in ("s1", "s2", "s3"):
+            if var not in r:
+                break
+            path.append(r[var]["value"])
+        hierarchies[r["wd"]["value"]].append(path)
+    return hierarchies
+
+# -------------------------------
+# 8. Keep the Wikidata entities that are cities (batched)
+# -------------------------------
+async def get_wikidata_cities(session, wd_uris):
+    query = WIKIDATA_CITIES_Q % values_block(wd_uris)
+    results = await sparql_json(session, WIKIDATA_SPARQL, query)
+    return {r["wd"]["value"] for r in results["results"]["bindings"]}
 
 # -------------------------------
-# 7. Build RDF knowledge graph
+# 9. Fetch remote data for all distinct POIs concurrently
+# -------------------------------
+async def fetch_batches(lookup, session, uris, desc):
+    # Concurrency per endpoint is bounded in fetch_json
+    return await tqdm_asyncio.gather(
+        *(lookup(session, batch) for batch in batches(sorted(uris))),
+        desc=desc,
+    )
+
+async def gather_all(df):
+    # One session per endpoint so keep-alive connections are reused
+    async with aiohttp.ClientSession() as db_session, aiohttp.ClientSession() as wd_session:
+        # A POI listed under several categories is looked up only once
+        mappings = {}
+        for batch in await fetch_batches(
+            get_wikidata_mappings, db_session, df["POI"].unique(), "Wikidata mappings"
+        ):
+            mappings.update(batch)
+
+        wd_uris = {wd_uri for wd_links in mappings.values() for wd_uri in wd_links}
+        cities = set()
+        for batch in await fetch_batches(get_wikidata_cities, wd_session, wd_uris, "City checks"):
+            cities |= batch
+
+        # First Wikidata entity that passes the semantic filter, per POI
+        verified = {
+            poi: next((wd_uri for wd_uri in wd_links if wd_uri in cities), None)  # or is_poi_wikidata(), etc.
+            for poi, wd_links in mappings.items()
+        }
+
+        # Type hierarchies only for unverified POIs, one query per batch of distinct types
+        type_uris = {wd_links[0] for poi, wd_links in mappings.items() if wd_links and not verified[poi]}
+        hierarchies = {}
+        for batch in await fetch_batches(
+            get_wikidata_type_hierarchies, wd_session, type_uris, "Type hierarchies"
+        ):
+            hierarchies.update(batch)
+
+    return {
+        poi: (wd_links, verified[poi], hierarchies.get(wd_links[0], []) if wd_links else [])
+        for poi, wd_links in mappings.items()
+    }
+
+# -------------------------------
+# 10. Build RDF knowledge graph
 # -------------------------------
 def build_kg(df):
-    g = Graph()
-    for idx, row in tqdm(df.iterrows(), total=len(df), desc="Building KG"):
-        poi_uri = URIRef(row["POI"])
-        city_uri = URIRef(DBR[row["Location"].replace(" ", "_")])
-        type_str = row["Type"]
-
-        # POI triples
-        g.add((poi_uri, RDF.type, EX.POI))
-        g.add((poi_uri, EX.locatedIn, city_uri))
-        g.add((poi_uri, EX.typeString, Literal(type_str)))
-
-        # City triples
-        g.add((city_uri, RDF.type, EX.City))
-
-        # Loop through all owl:sameAs links from DBpedia to Wikidata
-        wd_links = get_wikidata_mapping(row["POI"])
-        verified_wd_uri = None
-
-        for wd_uri in wd_links:
-            print(wd_uri)
-            # Check content: only keep if it passes your semantic filter
-            if is_city_wikidata(wd_uri):  # or is_poi_wikidata(), etc.
-                verified_wd_uri = wd_uri
-                g.add((poi_uri, OWL.sameAs, URIRef(verified_wd_uri)))
-                print(f"✅ Verified city link added for {poi_uri}: {verified_wd_uri}")
-                break  # Stop once we find the first valid Wikidata entity
+    remote = asyncio.run(gather_all(df))
+
+    # One URIRef per distinct city, shared by all its POIs
+    loc_to_city_uri = {loc: URIRef(DBR[loc.replace(" ", "_")]) for loc in df["Location"].unique()}
+
+    g = Graph(store=GRAPH_STORE)
+    rows = zip(df["POI"].to_numpy(), df["Location"].to_numpy(), df["Type"].to_numpy())
+    for poi, loc, type_str in tqdm(rows, total=len(df), desc="Building KG"):
+        wd_links, verified_wd_uri, hierarchy = remote[poi]
+        poi_uri = URIRef(poi)
+        city_uri = loc_to_city_uri[loc]
+
+        quads = [
+            # POI triples
+            (poi_uri, RDF.type, EX_POI, g),
+            (poi_uri, EX_LOCATED_IN, city_uri, g),
+            (poi_uri, EX_TYPE_STRING, Literal(type_str), g),
+
+            # City triples
+            (city_uri, RDF.type, EX_CITY, g),
+        ]
+
+        if verified_wd_uri:
+            quads.append((poi_uri, OWL.sameAs, URIRef(verified_wd_uri), g))
+            print(f"✅ Verified city link added for {poi_uri}: {verified_wd_uri}")
 
         # Optional: log cases with no valid Wikidata link
         if not verified_wd_uri:
             print(f"⚠️ No valid Wikidata city found for {poi_uri}")
 
             # Type hierarchy
-            hierarchy = get_wikidata_type_hierarchy(wd_links[0])
-            prev_type_uri = URIRef(EX[type_str.replace(" ", "_")])
-            g.add((poi_uri, EX.hasType, prev_type_uri))
-            g.add((prev_type_uri, RDF.type, EX.AttractionType))
-            for super_uri, label in hierarchy:
-                super_ref = URIRef(super_uri)
-                g.add((prev_type_uri, RDFS.subClassOf, super_ref))
-                prev_type_uri = super_ref
+            type_uri = URIRef(EX[type_str.replace(" ", "_")])
+            quads.append((poi_uri, EX_HAS_TYPE, type_uri, g))
+            quads.append((type_uri, RDF.type, EX_ATTRACTION_TYPE, g))
+            # Each path is ordered by depth, so link consecutive levels only
+            for path in hierarchy:
+                sub_ref = type_uri
+                for super_uri in path:
+                    super_ref = URIRef(super_uri)
+                    quads.append((sub_ref, RDFS.subClassOf, super_ref, g))
+                    sub_ref = super_ref
+
+        g.addN(quads)
 
     return g
 
 # -------------------------------
-# 8. Main pipeline
+# 11. Main pipeline
 # -------------------------------
-all_records = []
+# One list per column, turned into a DataFrame in one go
+pois, cats, types, locs = [], [], [], []
 
 categories = get_visitor_attraction_categories(limit=5)
 print(f"Found {len(categories)} categories")
 
 for cat_uri in tqdm(categories, desc="Processing categories"):
-    pairs = get_pois_for_category(cat_uri)
-    for poi_uri, category_uri in pairs:
+    for poi_uri, category_uri in get_pois_for_category(cat_uri):
         type_str, location_str = parse_category_uri(category_uri)
         if type_str and location_str:
-            all_records.append({
-                "POI": poi_uri,
-                "Category": category_uri,
-                "Type": type_str,
-                "Location": location_str
-            })
-
-df = pd.DataFrame(all_records)
+            pois.append(poi_uri)
+            cats.append(category_uri)
+            types.append(type_str)
+            locs.append(location_str)
+
+df = pd.DataFrame({"POI": pois, "Category": cats, "Type": types, "Location": locs})
 print(f"Total POIs extracted: {len(df)}")
 
 # Build and serialize KG
 kg = build_kg(df)
-kg.serialize("tourist_kg.ttl", format="turtle")
-print("Knowledge graph saved to tourist_kg.ttl")
+# N-Triples for machine reloading (fast, line-oriented)
+kg.serialize("tourist_kg.nt", format="nt")
+print("Knowledge graph saved to tourist_kg.nt")
+
+if WRITE_TURTLE:
+    kg.serialize("tourist_kg.ttl", format="turtle")
+    print("Knowledge graph saved to tourist_kg.ttl")
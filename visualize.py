@@ -1,15 +1,11 @@
 import networkx as nx
 import matplotlib.pyplot as plt
 from rdflib import Graph
+from kg_utils import cached_layout
 
 # Load the knowledge graph you created earlier
 g = Graph()
-g.parse("tourist_kg.ttl", format="turtle")
-
-# Convert RDFLib graph to NetworkX
-G = nx.DiGraph()
-for s, p, o in g:
-    G.add_edge(str(s), str(o), predicate=str(p))
+g.parse("tourist_kg.nt", format="nt")
 
 # --- Helper function to simplify labels ---
 def short_label(uri):
@@ -27,8 +23,12 @@ def short_label(uri):
     else:
         return uri.split("/")[-1]
 
-# Apply label simplification
-labels = {node: short_label(node) for node in G.nodes()}
+# Convert RDFLib graph to NetworkX
+G = nx.DiGraph()
+G.add_edges_from((str(s), str(o), {"predicate": str(p)}) for s, p, o in g)
+
+# Apply label simplification once, stored as a node attribute
+nx.set_node_attributes(G, {node: short_label(node) for node in G}, "label")
 
 # --- Filter only one city and its connected nodes ---
 # You can pick any city in your graph:
@@ -39,10 +39,10 @@ subG = G.subgraph(neighbors)
 
 # --- Plot ---
 plt.figure(figsize=(10, 8))
-pos = nx.spring_layout(subG, k=0.6, iterations=40)
+pos = cached_layout(subG, "kg_pos.pkl", k=0.6, iterations=40)
 nx.draw_networkx_nodes(subG, pos, node_color="lightblue", node_size=900)
 nx.draw_networkx_edges(subG, pos, arrows=True, alpha=0.5)
-nx.draw_networkx_labels(subG, pos, labels=labels, font_size=9)
+nx.draw_networkx_labels(subG, pos, labels=nx.get_node_attributes(subG, "label"), font_size=9)
 plt.title(f"Knowledge Graph for Tourist Attractions in {city_name}")
 plt.axis("off")
 plt.show()